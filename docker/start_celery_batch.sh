@@ -0,0 +1,3 @@
+#!/bin/bash
+
+celery -A satpy_pygeoapi_plugin worker -Q ${SATPY_BATCH_QUEUE:-satpy-batch} --concurrency ${SATPY_BATCH_CONCURRENCY:-4} --loglevel=DEBUG -E
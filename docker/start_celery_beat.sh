@@ -0,0 +1,3 @@
+#!/bin/bash
+
+celery -A satpy_pygeoapi_plugin beat --loglevel=DEBUG
@@ -3,6 +3,9 @@ import os
 
 redis_host = os.environ.get("REDIS_HOST", "redis")
 redis_port = os.environ.get("REDIS_PORT", 6379)
+product_store_cleanup_interval = float(
+    os.environ.get("SATPY_PRODUCT_STORE_CLEANUP_INTERVAL", 600)
+)
 
 
 app = Celery(
@@ -11,11 +14,24 @@ app = Celery(
     backend=f"redis://{redis_host}:{redis_port}",
     result_backend=f"redis://{redis_host}:{redis_port}",
     result_extended=True,
-    include=["satpy_pygeoapi_plugin.process_netcdf"],
+    include=[
+        "satpy_pygeoapi_plugin.process_netcdf",
+        "satpy_pygeoapi_plugin.process_batch",
+        "satpy_pygeoapi_plugin.product_store",
+    ],
 )
 
 app.conf.update(
     result_expires=3600,
+    # Each worker consumes its own queue, used to compress the shared memory
+    # cache rasters on the host they were written on
+    worker_direct=True,
+    beat_schedule={
+        "cleanup-product-store": {
+            "task": "satpy_pygeoapi_plugin.product_store.cleanup_product_store",
+            "schedule": product_store_cleanup_interval,
+        },
+    },
 )
 
 if __name__ == "__main__":
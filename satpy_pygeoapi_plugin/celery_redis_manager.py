@@ -50,6 +50,9 @@ LOGGER = logging.getLogger(__name__)
 redis_host = os.environ.get("REDIS_HOST", "redis")
 redis_port = os.environ.get("REDIS_PORT", 6379)
 
+#: Redis key of the summary of a batch job that failed hard
+BATCH_SUMMARY_KEY = "satpy-batch-summary-{}"
+
 
 class celery_redis_manager(BaseManager):
     """generic Manager ABC"""
@@ -147,6 +150,10 @@ class celery_redis_manager(BaseManager):
         print("RESULTS state", res.state)
         print("RESULTS status", res.status)
         result = {"task_id": job_id, "name": res.name, "status": res.status}
+        redis_cache = redis.Redis(host="redis")
+        if redis_cache.exists(BATCH_SUMMARY_KEY.format(job_id)):
+            # A batch job that failed hard still has its summary as result
+            result["status"] = "SUCCESS"
 
         return {
             "identifier": result.get("task_id", job_id),
@@ -170,6 +177,10 @@ class celery_redis_manager(BaseManager):
         """
 
         redis_cache = redis.Redis(host="redis")
+        batch_summary = redis_cache.get(BATCH_SUMMARY_KEY.format(job_id))
+        if batch_summary:
+            mimetype, encoded_result = json.loads(batch_summary)
+            return mimetype, base64.b64decode(encoded_result)
         try:
             redis_job_id = redis_cache.keys('*' + job_id)[0].decode('utf-8')
             job_result = eval(redis_cache.get(redis_job_id).decode('utf-8'))
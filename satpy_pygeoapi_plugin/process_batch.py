@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2023
+#
+# Author(s):
+#
+#   Trygve Aspenes <trygveas@met.no>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Batch generation of satpy products for all passes in a time range."""
+
+import os
+import json
+import base64
+import logging
+from glob import glob
+from datetime import datetime, timezone
+from satpy_pygeoapi_plugin.celery import app
+from satpy_pygeoapi_plugin.celery_redis_manager import BATCH_SUMMARY_KEY
+from satpy_pygeoapi_plugin.process_netcdf import (
+    _parse_filename,
+    _get_satpy_products,
+    _generate_products_and_mapfile,
+    _validate_writer_options,
+)
+from celery import Task, chord, group
+from celery.exceptions import SoftTimeLimitExceeded
+from celery.result import AsyncResult
+
+from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
+
+LOGGER = logging.getLogger(__name__)
+
+netcdf_search_path = os.environ.get("SATPY_NETCDF_PATH", "/pygeoapi/")
+# Passes are generated on this queue. The concurrency of the workers
+# consuming it bounds the number of passes generated in parallel.
+batch_queue = os.environ.get("SATPY_BATCH_QUEUE", "satpy-batch")
+# Seconds a pass may take before it is reported as failed, default 30 minutes
+batch_pass_time_limit = int(os.environ.get("SATPY_BATCH_PASS_TIME_LIMIT", 1800))
+
+#: Process metadata and description
+PROCESS_METADATA = {
+    "version": "0.0.1",
+    "id": "process-netcdf-batch",
+    "title": {"en": "netcdf batch"},
+    "description": {
+        "en": "Generate satpy products for all passes of the given "
+        "platforms and instruments within a time range. Each pass is "
+        "generated as a separate celery task, and the results and "
+        "failures are collected into one job.",
+    },
+    "keywords": ["satpy", "netcdf", "batch"],
+    "links": [],
+    "inputs": {
+        "platforms": {
+            "title": "Platforms",
+            "description": "Platform names to process, eg. noaa19. "
+            "All platforms are processed if not given.",
+            "schema": {"type": "array", "items": {"type": "string"}},
+            "minOccurs": 0,
+            "maxOccurs": 1,
+            "metadata": None,
+            "keywords": ["platform"],
+        },
+        "instruments": {
+            "title": "Instruments",
+            "description": "Instruments to process, eg. avhrr. Only the "
+            "netcdf files of these instruments are read for each pass. "
+            "All instruments are processed if not given.",
+            "schema": {"type": "array", "items": {"type": "string"}},
+            "minOccurs": 0,
+            "maxOccurs": 1,
+            "metadata": None,
+            "keywords": ["instrument"],
+        },
+        "start_time": {
+            "title": "Start time",
+            "description": "Only passes starting at or after this time, "
+            "eg. 2023-01-24T00:00:00Z",
+            "schema": {"type": "string", "format": "date-time"},
+            "minOccurs": 1,
+            "maxOccurs": 1,
+            "metadata": None,
+            "keywords": ["time"],
+        },
+        "end_time": {
+            "title": "End time",
+            "description": "Only passes starting at or before this time, "
+            "eg. 2023-01-25T00:00:00Z",
+            "schema": {"type": "string", "format": "date-time"},
+            "minOccurs": 1,
+            "maxOccurs": 1,
+            "metadata": None,
+            "keywords": ["time"],
+        },
+        "layers": {
+            "title": "Layers",
+            "description": "The satpy products to generate for each pass",
+            "schema": {"type": "array", "items": {"type": "string"}},
+            "minOccurs": 0,
+            "maxOccurs": 1,
+            "metadata": None,
+            "keywords": ["layer", "product"],
+        },
+        "writer_options": {
+            "title": "Writer options",
+            "description": "Geotiff writer options per layer, "
+            'eg. {"overview": {"compress": "ZSTD"}}. Supported options are '
+            "compress, zlevel, predictor, tiled, blockxsize, blockysize "
+            "and overviews.",
+            "schema": {"type": "object"},
+            "minOccurs": 0,
+            "maxOccurs": 1,
+            "metadata": None,
+            "keywords": ["geotiff"],
+        },
+    },
+    "outputs": {
+        "summary": {
+            "title": "Batch summary",
+            "description": "The passes generated and the passes failed",
+            "schema": {"type": "object", "contentMediaType": "application/json"},
+        }
+    },
+    "example": {
+        "mode": "async",
+        "inputs": {
+            "platforms": ["noaa19"],
+            "instruments": ["avhrr"],
+            "start_time": "2023-01-24T00:00:00Z",
+            "end_time": "2023-01-25T00:00:00Z",
+            "layers": ["overview"],
+        },
+    },
+}
+
+
+def _parse_time(time_string):
+    """Parse an RFC 3339 time string as given in the request to naive UTC."""
+    try:
+        parsed_time = datetime.fromisoformat(time_string)
+    except (TypeError, ValueError):
+        raise ProcessorExecuteError(f"Cannot parse time: {time_string}")
+    if parsed_time.tzinfo is not None:
+        parsed_time = parsed_time.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed_time
+
+
+def _as_list(value):
+    """Allow a single string where a list of strings is expected."""
+    if isinstance(value, str):
+        return [value]
+    return value
+
+
+def _find_passes(path, platforms, instruments, start_time, end_time):
+    """Find the netcdf paths of each pass within the time range.
+
+    Passes are identified by platform name, start and end time, so netcdf
+    files from several instruments of the same pass are grouped together.
+    Returns a list of netcdf path lists, one per pass.
+    """
+    passes = {}
+    for netcdf_path in sorted(glob(os.path.join(path, "*.nc"))):
+        parsed = _parse_filename(netcdf_path)
+        if not parsed:
+            continue
+        (_path, _platform_name, _instrument, _start_time, _end_time) = parsed
+        if platforms and _platform_name not in platforms:
+            continue
+        if instruments and _instrument not in instruments:
+            continue
+        pass_start_time = datetime.strptime(_start_time, "%Y%m%d%H%M%S")
+        if not start_time <= pass_start_time <= end_time:
+            continue
+        passes.setdefault((_platform_name, _start_time, _end_time), []).append(
+            netcdf_path
+        )
+    return list(passes.values())
+
+
+@app.task(track_started=True, soft_time_limit=batch_pass_time_limit)
+def generate_pass(netcdf_paths, ms_satpy_products, writer_options=None):
+    """Generate products for one pass from the given netcdf paths.
+
+    Errors, also the soft time limit, are returned in the pass result, so
+    they end up in the summary without failing the batch.
+    """
+    try:
+        # Passes are not rendered, so skip the shared memory cache
+        _generate_products_and_mapfile(
+            netcdf_paths[0],
+            ms_satpy_products,
+            writer_options,
+            use_shm_cache=False,
+            netcdf_paths=netcdf_paths,
+        )
+    except SoftTimeLimitExceeded:
+        LOGGER.error("Pass %s exceeded %s seconds", netcdf_paths, batch_pass_time_limit)
+        message = f"Time limit of {batch_pass_time_limit} seconds exceeded"
+        return {"netcdf_files": netcdf_paths, "message": message}
+    except Exception as err:
+        LOGGER.exception(err)
+        return {"netcdf_files": netcdf_paths, "message": str(err)}
+    return {"netcdf_files": netcdf_paths}
+
+
+def _summarize_passes(pass_results):
+    """Encode the pass results as the batch job result."""
+    summary = {"generated": [], "failed": []}
+    for pass_result in pass_results:
+        if "message" in pass_result:
+            summary["failed"].append(pass_result)
+        else:
+            summary["generated"].append(pass_result["netcdf_files"])
+    LOGGER.info("Batch generated: %s", len(summary["generated"]))
+    LOGGER.info("Batch failed: %s", len(summary["failed"]))
+    encoded_result = base64.b64encode(json.dumps(summary).encode("utf-8"))
+    return "application/json", encoded_result.decode("ascii")
+
+
+@app.task
+def collect_passes(pass_results):
+    """Collect the pass results into one batch job result."""
+    return _summarize_passes(pass_results)
+
+
+def _collect_pass_tasks(pass_tasks):
+    """Collect the pass results from the pass task ids."""
+    pass_results = []
+    for pass_task_id, netcdf_paths in pass_tasks:
+        result = AsyncResult(pass_task_id, app=app)
+        if result.successful():
+            pass_results.append(result.result)
+        else:
+            message = f"{result.state}: {result.result}"
+            pass_results.append({"netcdf_files": netcdf_paths, "message": message})
+    return _summarize_passes(pass_results)
+
+
+@app.task
+def collect_failed_passes(request, exc, traceback, job_id, pass_tasks):
+    """Chord error callback, still giving the batch job a summary.
+
+    Passes only fail by returning a message, so this is only called when a
+    pass task fails hard, eg. by a lost worker. Celery marks the job failed,
+    so the summary is stored under BATCH_SUMMARY_KEY, where the manager
+    looks for it before the job result.
+    """
+    LOGGER.error("Batch %s failed: %s", job_id, exc)
+    app.backend.set(
+        BATCH_SUMMARY_KEY.format(job_id),
+        json.dumps(_collect_pass_tasks(pass_tasks)),
+    )
+
+
+class ProcessNetcdfBatchProcessor(BaseProcessor, Task):
+    """Process NetCDF batch Processor"""
+
+    def __init__(self, processor_def):
+        """
+        Initialize object
+
+        :param processor_def: provider definition
+
+        :returns: pygeoapi.process.process_batch.ProcessNetcdfBatchProcessor
+        """
+        super().__init__(processor_def, PROCESS_METADATA)
+
+    @app.task(bind=True, track_started=True)
+    def execute(task, self, data):
+        start_time = _parse_time(data.get("start_time"))
+        end_time = _parse_time(data.get("end_time"))
+        if end_time < start_time:
+            raise ProcessorExecuteError("end_time is before start_time")
+        ms_satpy_products = _get_satpy_products(_as_list(data.get("layers")), None)
+        writer_options = _validate_writer_options(data.get("writer_options"))
+
+        passes = _find_passes(
+            netcdf_search_path,
+            _as_list(data.get("platforms")),
+            _as_list(data.get("instruments")),
+            start_time,
+            end_time,
+        )
+        LOGGER.info("Batch passes: %s", len(passes))
+        if not passes:
+            return collect_passes([])
+
+        pass_signatures = []
+        for netcdf_paths in passes:
+            pass_signature = generate_pass.s(
+                netcdf_paths, ms_satpy_products, writer_options
+            ).set(queue=batch_queue)
+            pass_signature.freeze()
+            pass_signatures.append(pass_signature)
+        pass_tasks = [
+            (pass_signature.id, pass_signature.args[0])
+            for pass_signature in pass_signatures
+        ]
+        # Replace this task with the chord, so the job id of the batch
+        # request gets the collected result of all passes.
+        return task.replace(
+            chord(
+                group(pass_signatures),
+                collect_passes.s().on_error(
+                    collect_failed_passes.s(task.request.id, pass_tasks)
+                ),
+            )
+        )
+
+    def __repr__(self):
+        return f"<ProcessNetcdfBatchProcessor> {self.name}"
+
+
+app.register_task(
+    ProcessNetcdfBatchProcessor(
+        {"name": "satpy_pygeoapi_plugin.process_batch.ProcessNetcdfBatchProcessor"}
+    )
+)
@@ -24,15 +24,33 @@
 
 import re
 import os
+import json
 import base64
+import hashlib
+import dask
 import logging
 import rasterio
+import rasterio.shutil
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.errors import RasterioIOError
+from rasterio.transform import from_bounds
 import mapscript
 from glob import glob
 from satpy import Scene
+from satpy.writers import compute_writer_results, get_enhanced_image
 from datetime import datetime
 from satpy_pygeoapi_plugin.celery import app
-from celery import Task
+from satpy_pygeoapi_plugin.product_store import (
+    make_product_directory,
+    product_store_path,
+    shm_cache_path,
+    shm_compress_in_progress,
+    shm_compress_marker,
+    touch_product,
+)
+from celery import Task, current_task
+from celery.utils import worker_direct
 
 from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
 
@@ -42,6 +60,58 @@ debug_on()
 
 LOGGER = logging.getLogger(__name__)
 
+# GDAL threads used for geotiff compression
+geotiff_num_threads = os.environ.get("SATPY_GEOTIFF_NUM_THREADS", "ALL_CPUS")
+# Maximum size of a rendered image stored as job result, default 10 MB
+max_result_size = int(os.environ.get("SATPY_MAX_RESULT_SIZE", 10 * 1024**2))
+
+#: Geotiff writer options a request can give per product, with a value check
+WRITER_OPTIONS = {
+    "compress": lambda value: value in ("DEFLATE", "LZW", "ZSTD", "LZMA", "NONE"),
+    "zlevel": lambda value: type(value) is int and 1 <= value <= 9,
+    "predictor": lambda value: type(value) is int and value in (1, 2),
+    "tiled": lambda value: isinstance(value, bool),
+    "blockxsize": lambda value: type(value) is int and value > 0 and value % 16 == 0,
+    "blockysize": lambda value: type(value) is int and value > 0 and value % 16 == 0,
+    "overviews": lambda value: isinstance(value, list)
+    and all(type(factor) is int and factor > 1 for factor in value),
+}
+
+#: Image formats a request can ask for, with the GetMap FORMAT and TRANSPARENT,
+#: and the mapserver OUTPUTFORMAT to add for formats mapserver has no default of
+IMAGE_FORMATS = {
+    "png": {"ows_format": "image/png", "transparent": "TRUE"},
+    "png8": {
+        "ows_format": "png8",
+        "transparent": "TRUE",
+        "driver": "AGG/PNG8",
+        "mimetype": "image/png; mode=8bit",
+        "extension": "png",
+        "imagemode": mapscript.MS_IMAGEMODE_RGBA,
+        "options": {"QUANTIZE_FORCE": "on", "QUANTIZE_COLORS": "256"},
+    },
+    "jpeg": {
+        "ows_format": "jpeg",
+        "transparent": "FALSE",
+        "driver": "AGG/JPEG",
+        "mimetype": "image/jpeg",
+        "extension": "jpg",
+        "imagemode": mapscript.MS_IMAGEMODE_RGB,
+        "options": {},
+        "quality": True,
+    },
+    "webp": {
+        "ows_format": "webp",
+        "transparent": "TRUE",
+        "driver": "GDAL/WEBP",
+        "mimetype": "image/webp",
+        "extension": "webp",
+        "imagemode": mapscript.MS_IMAGEMODE_RGBA,
+        "options": {},
+        "quality": True,
+    },
+}
+
 #: Process metadata and description
 PROCESS_METADATA = {
     "version": "0.0.1",
@@ -85,6 +155,47 @@ PROCESS_METADATA = {
             "metadata": None,
             "keywords": ["message"],
         },
+        "format": {
+            "title": "Format",
+            "description": "Image format of the result, one of png, png8 "
+            "(paletted 8 bit png), jpeg or webp",
+            "schema": {"type": "string", "enum": list(IMAGE_FORMATS), "default": "png"},
+            "minOccurs": 0,
+            "maxOccurs": 1,
+            "metadata": None,
+            "keywords": ["format", "image"],
+        },
+        "quality": {
+            "title": "Quality",
+            "description": "Quality of jpeg and webp images",
+            "schema": {"type": "integer", "minimum": 1, "maximum": 100, "default": 85},
+            "minOccurs": 0,
+            "maxOccurs": 1,
+            "metadata": None,
+            "keywords": ["quality", "image"],
+        },
+        "max_result_size": {
+            "title": "Max result size",
+            "description": "Maximum size of the image in bytes, at most the "
+            "configured SATPY_MAX_RESULT_SIZE",
+            "schema": {"type": "integer", "minimum": 1},
+            "minOccurs": 0,
+            "maxOccurs": 1,
+            "metadata": None,
+            "keywords": ["size", "image"],
+        },
+        "writer_options": {
+            "title": "Writer options",
+            "description": "Geotiff writer options per layer, "
+            'eg. {"overview": {"compress": "ZSTD"}}. Supported options are '
+            "compress, zlevel, predictor, tiled, blockxsize, blockysize "
+            "and overviews.",
+            "schema": {"type": "object"},
+            "minOccurs": 0,
+            "maxOccurs": 1,
+            "metadata": None,
+            "keywords": ["geotiff"],
+        },
     },
     "outputs": {
         "echo": {
@@ -106,17 +217,14 @@ PROCESS_METADATA = {
 
 
 def _parse_filename(netcdf_path):
-    print("########################################################")
-    print(netcdf_path)
-    print("########################################################")
-
     """Parse the netcdf to return start_time."""
+    LOGGER.debug("Parse netcdf path: %s", netcdf_path)
     pattern_match = "^(.*)(metopa|metopb|metopc|noaa18|noaa19|noaa20|npp|aqua|terra|fy3d)-(avhrr|viirs-mband|viirs-dnb|modis-1km|mersi2-1k)-(\d{14})-(\d{14})\.nc$"
     pattern = re.compile(pattern_match)
     mtchs = pattern.match(netcdf_path)
     # start_time = None
     if mtchs:
-        print("Pattern match:", mtchs.groups())
+        LOGGER.debug("Pattern match: %s", mtchs.groups())
         # start_time = datetime.strptime(mtchs.groups()[5], "%Y%m%d%H%M%S")
         return mtchs.groups()
     return None
@@ -151,15 +259,313 @@ def _get_satpy_products(satpy_products, full_request):
     return ms_satpy_products
 
 
+def _validate_writer_options(writer_options):
+    """Check the writer_options input against WRITER_OPTIONS.
+
+    writer_options is a dict of product name to geotiff writer options,
+    eg. {"overview": {"compress": "ZSTD"}}.
+    """
+    if writer_options is None:
+        return {}
+    if not isinstance(writer_options, dict):
+        raise ProcessorExecuteError(
+            "writer_options must be an object of layer options"
+        )
+    for satpy_product, options in writer_options.items():
+        if not isinstance(options, dict):
+            raise ProcessorExecuteError(
+                f"writer_options of {satpy_product} must be an object"
+            )
+        for key, value in options.items():
+            if key not in WRITER_OPTIONS:
+                raise ProcessorExecuteError(
+                    f"Unsupported writer option {key}, "
+                    f"use one of {list(WRITER_OPTIONS)}"
+                )
+            if not WRITER_OPTIONS[key](value):
+                raise ProcessorExecuteError(
+                    f"Invalid value {value!r} for writer option {key}"
+                )
+    return writer_options
+
+
+def _writer_options_suffix(writer_options):
+    """Get a product filename suffix identifying the writer options.
+
+    The product filename is the key of the product store, so products
+    written with other options need another filename.
+    """
+    if not writer_options:
+        return ""
+    options_hash = hashlib.sha1(
+        json.dumps(writer_options, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+    return f"-{options_hash[:8]}"
+
+
+def _shm_header_filename(shm_filename):
+    """The ENVI header belonging to a raw raster in the shared memory cache."""
+    return os.path.splitext(shm_filename)[0] + ".hdr"
+
+
+def _product_exists(_satpy_product):
+    """Check if the product is in the product store, or in the shared memory
+    cache while its geotiff is compressed.
+
+    A cached raster without geotiff and running compress is orphaned, and the
+    product is generated again.
+    """
+    if os.path.exists(_satpy_product["satpy_product_filename"]):
+        return True
+    shm_filename = _satpy_product["satpy_product_shm_filename"]
+    return bool(
+        shm_filename
+        and os.path.exists(shm_filename)
+        and shm_compress_in_progress(shm_filename)
+    )
+
+
+def _get_metadata_raster(_satpy_product):
+    """Get an existing raster of the product to read the layer metadata from.
+
+    The geotiff may still be compressed, but then the shared memory cache
+    raster is kept by the cleanup.
+    """
+    satpy_product_filename = _satpy_product["satpy_product_filename"]
+    if os.path.exists(satpy_product_filename):
+        return satpy_product_filename
+    shm_filename = _satpy_product["satpy_product_shm_filename"]
+    if shm_filename and os.path.exists(shm_filename):
+        return shm_filename
+    return satpy_product_filename
+
+
+def _use_shm_raster(layer, shm_filename):
+    """Let the layer read the shared memory cache raster, if still cached."""
+    try:
+        dataset = rasterio.open(shm_filename)
+    except RasterioIOError:
+        return
+    # Raw rasters have no color interpretation, so tell mapserver
+    # which bands are grey or rgb and alpha.
+    bands = {1: "1", 2: "1,1,1,2", 3: "1,2,3", 4: "1,2,3,4"}[dataset.count]
+    dataset.close()
+    layer.data = shm_filename
+    layer.setProcessing(f"BANDS={bands}")
+
+
+def _touch_product(_satpy_product):
+    """Register access to all files of a product."""
+    touch_product(_satpy_product["satpy_product_filename"])
+    shm_filename = _satpy_product["satpy_product_shm_filename"]
+    if shm_filename:
+        touch_product(shm_filename)
+        touch_product(_shm_header_filename(shm_filename))
+
+
+def _get_gdal_creation_options(writer_options, mode):
+    """Translate the writer options of a product to GTiff creation options.
+
+    The defaults follow the satpy geotiff writer, so a product gets the same
+    geotiff with or without the shared memory cache. Overviews are built
+    after the copy, see _compress_shm_products.
+    """
+    creation_options = {
+        "compress": "DEFLATE",
+        "zlevel": 6,
+        "tiled": True,
+        "num_threads": geotiff_num_threads,
+    }
+    for key, value in writer_options.items():
+        if key != "overviews":
+            creation_options[key] = value
+    if mode.startswith("RGB"):
+        creation_options["photometric"] = "RGB"
+    if mode.endswith("A"):
+        creation_options["alpha"] = "YES"
+    _creation_options = {}
+    for key, value in creation_options.items():
+        if isinstance(value, bool):
+            value = "YES" if value else "NO"
+        _creation_options[key.upper()] = str(value)
+    return _creation_options
+
+
+def _write_shm_raster(shm_filename, data, area):
+    """Write an uncompressed ENVI raster with header to the shared memory cache.
+
+    The files are written with temporary names and moved in place, header
+    first, so readers never see a partial raster.
+    """
+    base, ext = os.path.splitext(shm_filename)
+    tmp_shm_filename = f"{base}.{os.getpid()}.tmp{ext}"
+    make_product_directory(shm_filename)
+    with rasterio.open(
+        tmp_shm_filename,
+        "w",
+        driver="ENVI",
+        width=area.width,
+        height=area.height,
+        count=data.shape[0],
+        dtype=data.dtype,
+        crs=CRS.from_wkt(area.crs.to_wkt()),
+        transform=from_bounds(*area.area_extent, area.width, area.height),
+    ) as dst:
+        dst.write(data)
+    os.replace(
+        _shm_header_filename(tmp_shm_filename), _shm_header_filename(shm_filename)
+    )
+    os.replace(tmp_shm_filename, shm_filename)
+
+
+def _compress_shm_products(satpy_products_to_compress):
+    """Compress the shared memory cache rasters to geotiffs in the product store.
+
+    Like the satpy geotiff writer, the geotiffs get a TIFFTAG_DATETIME tag and
+    nearest neighbour overviews if asked for. Returns the compressed products.
+    """
+    print(datetime.now(), "Before compress")
+    compressed = []
+    for _satpy_product, mode, tiff_datetime in satpy_products_to_compress:
+        satpy_product_filename = _satpy_product["satpy_product_filename"]
+        shm_filename = _satpy_product["satpy_product_shm_filename"]
+        writer_options = _satpy_product["writer_options"]
+        tmp_satpy_product_filename = f"{satpy_product_filename}.{os.getpid()}.tmp"
+        # The compress may have waited in the queue, so restart the timeout
+        touch_product(shm_compress_marker(shm_filename))
+        try:
+            make_product_directory(satpy_product_filename)
+            rasterio.shutil.copy(
+                shm_filename,
+                tmp_satpy_product_filename,
+                driver="GTiff",
+                **_get_gdal_creation_options(writer_options, mode),
+            )
+            with rasterio.open(tmp_satpy_product_filename, "r+") as dst:
+                dst.update_tags(TIFFTAG_DATETIME=tiff_datetime)
+                if writer_options.get("overviews"):
+                    dst.build_overviews(writer_options["overviews"], Resampling.nearest)
+                    dst.update_tags(ns="rio_overview", resampling="nearest")
+            os.replace(tmp_satpy_product_filename, satpy_product_filename)
+            compressed.append(_satpy_product)
+        except Exception as err:
+            LOGGER.exception(err)
+            # Remove the cached raster to have the product generated again
+            for filename in (
+                tmp_satpy_product_filename,
+                shm_filename,
+                _shm_header_filename(shm_filename),
+            ):
+                try:
+                    os.remove(filename)
+                except FileNotFoundError:
+                    pass
+        finally:
+            try:
+                os.remove(shm_compress_marker(shm_filename))
+            except FileNotFoundError:
+                pass
+    print(datetime.now(), "After compress")
+    return compressed
+
+
+def _rewrite_mapfile(mapfile_filename, compressed):
+    """Let the layers of a saved mapfile read the compressed geotiffs.
+
+    Only layers still reading the shared memory cache raster of a compressed
+    product are changed, as the mapfile may be saved again meanwhile.
+    """
+    try:
+        map_object = mapscript.mapObj(mapfile_filename)
+    except mapscript.MapServerError as err:
+        LOGGER.warning("Cannot rewrite mapfile %s: %s", mapfile_filename, err)
+        return
+    geotiffs = {
+        _satpy_product["satpy_product_shm_filename"]: _satpy_product[
+            "satpy_product_filename"
+        ]
+        for _satpy_product in compressed
+    }
+    for layer_no in range(map_object.numlayers):
+        layer = map_object.getLayer(layer_no)
+        if layer.data in geotiffs:
+            layer.data = geotiffs[layer.data]
+            layer.clearProcessing()
+    base, ext = os.path.splitext(mapfile_filename)
+    tmp_mapfile_filename = f"{base}.{os.getpid()}.tmp{ext}"
+    map_object.save(tmp_mapfile_filename)
+    os.replace(tmp_mapfile_filename, mapfile_filename)
+
+
+@app.task
+def compress_shm_products(satpy_products_to_compress, mapfile_filename):
+    """Compress the shared memory cache rasters of a pass, then let the saved
+    mapfile read the geotiffs."""
+    compressed = _compress_shm_products(satpy_products_to_compress)
+    if compressed:
+        _rewrite_mapfile(mapfile_filename, compressed)
+
+
+def _start_compress_shm_products(satpy_products_to_compress, mapfile_filename):
+    """Compress the shared memory cache rasters in a follow-up task.
+
+    The shared memory cache is local to the host, so the task is sent to the
+    direct queue of this worker. Unlike a thread, the task survives the
+    worker process. Outside a worker the rasters are compressed right away.
+    """
+    hostname = current_task.request.hostname if current_task else None
+    if not hostname:
+        compress_shm_products(satpy_products_to_compress, mapfile_filename)
+        return
+    compress_shm_products.apply_async(
+        (satpy_products_to_compress, mapfile_filename),
+        queue=worker_direct(hostname),
+    )
+
+
+def _save_shm_products(resample_scene, satpy_products_to_save):
+    """Save products uncompressed to the shared memory cache.
+
+    The enhanced images of all products are computed in one dask graph. The
+    returned products are compressed to geotiffs after the mapfile is saved,
+    so the first requests do not wait for, and decompress, them.
+    """
+    finalized = []
+    for _satpy_product in satpy_products_to_save:
+        img = get_enhanced_image(resample_scene[_satpy_product["satpy_product"]])
+        finalized.append(img.finalize())
+    computed = dask.compute(*[data.data for data, _ in finalized])
+
+    satpy_products_to_compress = []
+    for _satpy_product, (_, mode), data in zip(
+        satpy_products_to_save, finalized, computed
+    ):
+        attrs = resample_scene[_satpy_product["satpy_product"]].attrs
+        shm_filename = _satpy_product["satpy_product_shm_filename"]
+        make_product_directory(shm_filename)
+        # Keeps the raster from the cleanup until compressed
+        with open(shm_compress_marker(shm_filename), "w") as marker:
+            marker.write(str(os.getpid()))
+        _write_shm_raster(shm_filename, data, attrs["area"])
+        satpy_products_to_compress.append(
+            (_satpy_product, mode, f"{attrs['start_time']:%Y:%m:%d %H:%M:%S}")
+        )
+    return satpy_products_to_compress
+
+
 def _generate_satpy_geotiff(netcdf_paths, satpy_products_to_generate):
-    """Generate and save geotiff to local disk in omerc based on actual area."""
+    """Generate and save geotiff to local disk in omerc based on actual area.
+
+    Returns the products saved to the shared memory cache, still to be
+    compressed to geotiffs.
+    """
     satpy_products = []
     for _satpy_product in satpy_products_to_generate:
-        if not os.path.exists(_satpy_product["satpy_product_filename"]):
+        if not _product_exists(_satpy_product):
             satpy_products.append(_satpy_product["satpy_product"])
     if not satpy_products:
         print("No products needs to be generated.")
-        return
+        return []
     print(os.environ)
     print("Need to generate: ", satpy_products)
     print(datetime.now(), "Before Scene")
@@ -184,13 +590,33 @@ def _generate_satpy_geotiff(netcdf_paths, satpy_products_to_generate):
     print(datetime.now(), "Before resample")
     resample_scene = swath_scene.resample(bb_area)
     print(datetime.now(), "Before save")
-    for _satpy_product in satpy_products_to_generate:
-        if _satpy_product["satpy_product"] in satpy_products:
+    satpy_products_to_save = [
+        _satpy_product
+        for _satpy_product in satpy_products_to_generate
+        if _satpy_product["satpy_product"] in satpy_products
+    ]
+    if satpy_products_to_save[0]["satpy_product_shm_filename"]:
+        satpy_products_to_compress = _save_shm_products(
+            resample_scene, satpy_products_to_save
+        )
+        print(datetime.now(), "After save")
+        return satpy_products_to_compress
+    # Delay the saves to compute all products in one dask graph
+    save_results = []
+    for _satpy_product in satpy_products_to_save:
+        make_product_directory(_satpy_product["satpy_product_filename"])
+        save_results.append(
             resample_scene.save_dataset(
                 _satpy_product["satpy_product"],
                 filename=_satpy_product["satpy_product_filename"],
+                compute=False,
+                num_threads=geotiff_num_threads,
+                **_satpy_product["writer_options"],
             )
+        )
+    compute_writer_results(save_results)
     print(datetime.now(), "After save")
+    return []
 
 
 def _fill_metadata_to_mapfile(netcdf_path, map_object):
@@ -209,9 +635,49 @@ def _fill_metadata_to_mapfile(netcdf_path, map_object):
     map_object.units = mapscript.MS_DD
 
 
-def _generate_layer(start_time, satpy_product, satpy_product_filename, layer):
-    """Generate a layer based on the metadata from geotiff."""
-    dataset = rasterio.open(satpy_product_filename)
+def _add_output_format(map_object, image_format, quality):
+    """Add the OUTPUTFORMAT of the requested image format to the mapfile."""
+    format_definition = IMAGE_FORMATS[image_format]
+    if "driver" not in format_definition:
+        return
+    output_format = mapscript.outputFormatObj(format_definition["driver"], image_format)
+    output_format.mimetype = format_definition["mimetype"]
+    output_format.extension = format_definition["extension"]
+    output_format.imagemode = format_definition["imagemode"]
+    if format_definition["transparent"] == "TRUE":
+        output_format.transparent = mapscript.MS_ON
+    for key, value in format_definition["options"].items():
+        output_format.setOption(key, value)
+    if format_definition.get("quality"):
+        output_format.setOption("QUALITY", str(quality))
+    map_object.appendOutputFormat(output_format)
+
+
+def _get_int_input(data, key, default, minimum, maximum):
+    """Get an integer input of the request between minimum and maximum."""
+    value = data.get(key, default)
+    if isinstance(value, bool):
+        raise ProcessorExecuteError(f"{key} must be an integer, got {value!r}")
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ProcessorExecuteError(f"{key} must be an integer, got {value!r}")
+    if not minimum <= value <= maximum:
+        raise ProcessorExecuteError(
+            f"{key} must be between {minimum} and {maximum}, got {value}"
+        )
+    return value
+
+
+def _generate_layer(
+    start_time, satpy_product, satpy_product_filename, layer, metadata_filename=None
+):
+    """Generate a layer based on the metadata from geotiff.
+
+    metadata_filename is another raster of the product to read the metadata
+    from, eg. while the geotiff is not written yet.
+    """
+    dataset = rasterio.open(metadata_filename or satpy_product_filename)
     bounds = dataset.bounds
     ll_x = bounds[0]
     ll_y = bounds[1]
@@ -235,6 +701,97 @@ def _generate_layer(start_time, satpy_product, satpy_product_filename, layer):
     dataset.close()
 
 
+def _generate_products_and_mapfile(
+    netcdf_path,
+    ms_satpy_products,
+    writer_options=None,
+    use_shm_cache=False,
+    netcdf_paths=None,
+):
+    """Generate the satpy products for one pass and save the mapfile.
+
+    The products are generated from netcdf_paths if given, otherwise from
+    all netcdf files of the pass of netcdf_path.
+
+    With use_shm_cache the products are handed off through the shared memory
+    cache, if configured. Returns the mapscript mapObj with one layer per
+    product, reading the shared memory cache rasters where available. The
+    saved mapfile reads the shared memory cache rasters until their geotiffs
+    are compressed, and is then rewritten to read the geotiffs.
+    """
+    (_path, _platform_name, _, _start_time, _end_time) = _parse_filename(
+        netcdf_path
+    )
+    start_time = datetime.strptime(_start_time, "%Y%m%d%H%M%S")
+    print("START TIME: ", start_time)
+    similar_netcdf_paths = netcdf_paths or _search_for_similar_netcdf_paths(
+        _path, _platform_name, _start_time, _end_time
+    )
+    print("Similar netcdf paths:", similar_netcdf_paths)
+
+    writer_options = _validate_writer_options(writer_options)
+    satpy_products_to_generate = []
+    for satpy_product in ms_satpy_products:
+        _writer_options = writer_options.get(satpy_product, {})
+        satpy_product_name = (
+            f"{satpy_product}-{start_time:%Y%m%d%H%M%S}"
+            f"{_writer_options_suffix(_writer_options)}"
+        )
+        satpy_product_filename = product_store_path(
+            start_time, _platform_name, f"{satpy_product_name}.tif"
+        )
+        satpy_product_shm_filename = None
+        if use_shm_cache:
+            satpy_product_shm_filename = shm_cache_path(
+                start_time, _platform_name, f"{satpy_product_name}.raw"
+            )
+        satpy_products_to_generate.append(
+            {
+                "satpy_product": satpy_product,
+                "satpy_product_filename": satpy_product_filename,
+                "satpy_product_shm_filename": satpy_product_shm_filename,
+                "writer_options": _writer_options,
+            }
+        )
+
+    satpy_products_to_compress = _generate_satpy_geotiff(
+        similar_netcdf_paths, satpy_products_to_generate
+    )
+    for satpy_product in satpy_products_to_generate:
+        _touch_product(satpy_product)
+
+    map_object = mapscript.mapObj()
+    _fill_metadata_to_mapfile(netcdf_path, map_object)
+
+    for satpy_product in satpy_products_to_generate:
+        layer = mapscript.layerObj()
+        _generate_layer(
+            start_time,
+            satpy_product["satpy_product"],
+            satpy_product["satpy_product_filename"],
+            layer,
+            _get_metadata_raster(satpy_product),
+        )
+        layer_no = map_object.insertLayer(layer)
+        if not os.path.exists(satpy_product["satpy_product_filename"]):
+            shm_filename = satpy_product["satpy_product_shm_filename"]
+            if shm_filename:
+                _use_shm_raster(map_object.getLayer(layer_no), shm_filename)
+    mapfile_filename = product_store_path(
+        start_time, _platform_name, f"satpy-products-{start_time:%Y%m%d%H%M%S}.map"
+    )
+    make_product_directory(mapfile_filename)
+    map_object.save(mapfile_filename)
+    if satpy_products_to_compress:
+        _start_compress_shm_products(satpy_products_to_compress, mapfile_filename)
+    # The rendering reads the uncompressed rasters while still cached
+    for layer_no, satpy_product in enumerate(satpy_products_to_generate):
+        shm_filename = satpy_product["satpy_product_shm_filename"]
+        if shm_filename:
+            _use_shm_raster(map_object.getLayer(layer_no), shm_filename)
+    return map_object
+
+
 class ProcessNetcdfProcessor(BaseProcessor, Task):
     """Process NetCDF Processor example"""
 
@@ -265,43 +822,29 @@ class ProcessNetcdfProcessor(BaseProcessor, Task):
         satpy_products = [data.get("layer", "overview")]
         full_request = None
 
-        (_path, _platform_name, _, _start_time, _end_time) = _parse_filename(
-            netcdf_path
-        )
-        start_time = datetime.strptime(_start_time, "%Y%m%d%H%M%S")
-        print("START TIME: ", start_time)
-        similar_netcdf_paths = _search_for_similar_netcdf_paths(
-            _path, _platform_name, _start_time, _end_time
-        )
-        print("Similar netcdf paths:", similar_netcdf_paths)
         ms_satpy_products = _get_satpy_products(satpy_products, full_request)
         print("satpy product/layer", ms_satpy_products)
 
-        satpy_products_to_generate = []
-        for satpy_product in ms_satpy_products:
-            satpy_product_filename = f"{satpy_product}-{start_time:%Y%m%d%H%M%S}.tif"
-            satpy_products_to_generate.append(
-                {
-                    "satpy_product": satpy_product,
-                    "satpy_product_filename": satpy_product_filename,
-                }
+        image_format = data.get("format", "png")
+        if image_format not in IMAGE_FORMATS:
+            raise ProcessorExecuteError(
+                f"Unknown format {image_format}, use one of {list(IMAGE_FORMATS)}"
             )
+        ows_format = IMAGE_FORMATS[image_format]["ows_format"]
+        transparent = IMAGE_FORMATS[image_format]["transparent"]
+        quality = _get_int_input(data, "quality", 85, 1, 100)
+        # The request can lower, but not raise, the configured limit
+        result_size_limit = _get_int_input(
+            data, "max_result_size", max_result_size, 1, max_result_size
+        )
 
-        _generate_satpy_geotiff(similar_netcdf_paths, satpy_products_to_generate)
-
-        map_object = mapscript.mapObj()
-        _fill_metadata_to_mapfile(netcdf_path, map_object)
-
-        for satpy_product in satpy_products_to_generate:
-            layer = mapscript.layerObj()
-            _generate_layer(
-                start_time,
-                satpy_product["satpy_product"],
-                satpy_product["satpy_product_filename"],
-                layer,
-            )
-            layer_no = map_object.insertLayer(layer)
-        map_object.save(f"satpy-products-{start_time:%Y%m%d%H%M%S}.map")
+        map_object = _generate_products_and_mapfile(
+            netcdf_path,
+            ms_satpy_products,
+            data.get("writer_options"),
+            use_shm_cache=True,
+        )
+        _add_output_format(map_object, image_format, quality)
 
         bbox = "50,-10,80,50"
         bbox = "-1200000,6000000,3200000,9000000"
@@ -313,9 +856,9 @@ class ProcessNetcdfProcessor(BaseProcessor, Task):
         query_params = (
             f"SERVICE=WMS&VERSION=1.3.0&REQUEST=GetMap&BBOX={bbox}"
             f"&CRS={epsg}&WIDTH=1200&HEIGHT=800&LAYERS={data.get('layer', 'overview')}&"
-            f"STYLES=&TIME={time_stamp}&FORMAT=image/png"
+            f"STYLES=&TIME={time_stamp}&FORMAT={ows_format}"
             "&DPI=96&MAP_RESOLUTION=96&FORMAT_OPTIONS=dpi:96&"
-            "TRANSPARENT=TRUE"
+            f"TRANSPARENT={transparent}"
         )
         try:
             ows_req.loadParamsFromURL(query_params)
@@ -332,6 +875,12 @@ class ProcessNetcdfProcessor(BaseProcessor, Task):
         map_object.OWSDispatch(ows_req)
         content_type = mapscript.msIO_stripStdoutBufferContentType()
         result = mapscript.msIO_getStdoutBufferBytes()
+        print("Result size", len(result))
+        if len(result) > result_size_limit:
+            raise ProcessorExecuteError(
+                f"Result of {len(result)} bytes is larger than the maximum "
+                f"{result_size_limit} bytes. Try format png8, jpeg or webp."
+            )
         encoded_result = base64.b64encode(result)
         # return mimetype, outputs
         print("CONTENT_TYPR", content_type)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2023
+#
+# Author(s):
+#
+#   Trygve Aspenes <trygveas@met.no>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Store for generated geotiffs and mapfiles.
+
+Products are stored under a root directory sharded by date and platform,
+eg. <root>/2023/01/24/noaa19/overview-20230124115334.tif. The modification
+time of a product is updated on every access, and the cleanup task removes
+products by age and least recent access to keep the store within size.
+
+Optionally freshly generated products are also kept as uncompressed ENVI
+rasters in a shared memory cache, eg. /dev/shm/satpy-products, with the
+same layout. These are read directly by mapserver for the first requests
+and removed by the cleanup task after a short time. While the geotiff of a
+cached raster is compressed, a .compressing marker file next to it keeps the
+raster from being removed, up to a timeout after which the compress is
+considered lost.
+"""
+
+import os
+import time
+import logging
+from satpy_pygeoapi_plugin.celery import app
+
+LOGGER = logging.getLogger(__name__)
+
+product_store_root = os.environ.get("SATPY_PRODUCT_STORE", "/tmp/satpy-products")
+# Default 20 GB
+product_store_max_bytes = int(
+    os.environ.get("SATPY_PRODUCT_STORE_MAX_BYTES", 20 * 1024**3)
+)
+# Default 7 days
+product_store_max_age = int(os.environ.get("SATPY_PRODUCT_STORE_MAX_AGE", 604800))
+
+# Empty shard directories younger than this are kept, as products may be
+# about to be written to them. Default 1 hour
+product_store_directory_grace = int(
+    os.environ.get("SATPY_PRODUCT_STORE_DIRECTORY_GRACE", 3600)
+)
+
+# Disabled if not set
+shm_cache_root = os.environ.get("SATPY_SHM_CACHE", "")
+# Default 2 GB
+shm_cache_max_bytes = int(os.environ.get("SATPY_SHM_CACHE_MAX_BYTES", 2 * 1024**3))
+# Default 5 minutes
+shm_cache_max_age = int(os.environ.get("SATPY_SHM_CACHE_MAX_AGE", 300))
+# Seconds a geotiff compress may take before its raster is orphaned,
+# default 10 minutes
+shm_compress_timeout = int(os.environ.get("SATPY_SHM_COMPRESS_TIMEOUT", 600))
+
+
+def _sharded_path(root, start_time, platform_name, filename):
+    """Get the path of a file below root."""
+    directory = os.path.join(
+        root, f"{start_time:%Y}", f"{start_time:%m}", f"{start_time:%d}", platform_name
+    )
+    return os.path.join(directory, filename)
+
+
+def make_product_directory(path):
+    """Create the shard directory of a product, right before writing it.
+
+    Creating it earlier lets the cleanup remove it while still empty. The
+    modification time of an existing directory is refreshed, so the cleanup
+    keeps it for the grace period.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    touch_product(directory)
+
+
+def product_store_path(start_time, platform_name, filename):
+    """Get the path of a product in the store."""
+    return _sharded_path(product_store_root, start_time, platform_name, filename)
+
+
+def shm_cache_path(start_time, platform_name, filename):
+    """Get the path of a product in the shared memory cache.
+
+    Returns None if the shared memory cache is disabled.
+    """
+    if not shm_cache_root:
+        return None
+    return _sharded_path(shm_cache_root, start_time, platform_name, filename)
+
+
+def shm_compress_marker(shm_filename):
+    """Get the marker file of a running compress of a cached raster."""
+    # Also covers the header, temporary and .aux.xml files of the raster
+    filename = os.path.basename(shm_filename).split(".")[0] + ".compressing"
+    return os.path.join(os.path.dirname(shm_filename), filename)
+
+
+def shm_compress_in_progress(shm_filename):
+    """Check if the geotiff of a cached raster is being compressed.
+
+    A marker older than shm_compress_timeout is from a lost compress.
+    """
+    try:
+        started = os.stat(shm_compress_marker(shm_filename)).st_mtime
+    except FileNotFoundError:
+        return False
+    return time.time() - started < shm_compress_timeout
+
+
+def touch_product(path):
+    """Register access to a product, used for least recently used eviction."""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def _list_products(root):
+    """List (last access, size, path) of all files in the store."""
+    products = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            products.append((stat.st_mtime, stat.st_size, path))
+    return products
+
+
+def _remove_empty_directories(root):
+    """Remove empty shard directories below root, unless recently created."""
+    newest_allowed = time.time() - product_store_directory_grace
+    for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+        if dirpath == root or dirnames or filenames:
+            continue
+        try:
+            if os.stat(dirpath).st_mtime > newest_allowed:
+                continue
+            os.rmdir(dirpath)
+        except OSError:
+            pass
+
+
+def _shm_geotiff_pending(path):
+    """Check if the geotiff of a shared memory cache file is being compressed."""
+    relative_directory = os.path.relpath(os.path.dirname(path), shm_cache_root)
+    # Also covers temporary and .aux.xml files of the raster
+    filename = os.path.basename(path).split(".")[0] + ".tif"
+    if os.path.exists(os.path.join(product_store_root, relative_directory, filename)):
+        return False
+    return shm_compress_in_progress(path)
+
+
+def cleanup_products(root, max_bytes, max_age, keep=None):
+    """Remove products older than max_age seconds, then the least recently
+    used products until the store is below max_bytes.
+
+    Files for which keep(path) is true are never removed.
+    Returns the number of removed files.
+    """
+    products = sorted(_list_products(root))
+    total_size = sum(size for _, size, _ in products)
+    oldest_allowed = time.time() - max_age
+    removed = 0
+    for last_access, size, path in products:
+        if last_access >= oldest_allowed and total_size <= max_bytes:
+            break
+        if keep and keep(path):
+            continue
+        # Products accessed since listing are no longer the least recently used
+        try:
+            if os.stat(path).st_mtime > last_access:
+                continue
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+        removed += 1
+    _remove_empty_directories(root)
+    LOGGER.info(
+        "Product store %s removed %s files, size now %s", root, removed, total_size
+    )
+    return removed
+
+
+@app.task
+def cleanup_product_store():
+    """Periodic cleanup of the product store and shared memory cache."""
+    removed = cleanup_products(
+        product_store_root, product_store_max_bytes, product_store_max_age
+    )
+    if shm_cache_root:
+        # Cached rasters are needed until their geotiff is written, unless
+        # the compress is lost
+        removed += cleanup_products(
+            shm_cache_root,
+            shm_cache_max_bytes,
+            shm_cache_max_age,
+            keep=_shm_geotiff_pending,
+        )
+    return removed
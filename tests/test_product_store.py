@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2023
+#
+# Author(s):
+#
+#   Trygve Aspenes <trygveas@met.no>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the product store cleanup."""
+
+import os
+import time
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("celery")
+
+from satpy_pygeoapi_plugin import product_store  # noqa: E402
+
+START_TIME = datetime(2023, 1, 24, 11, 53, 34)
+
+
+def _write_product(path, size, age):
+    """Write a product of size bytes, last accessed age seconds ago."""
+    product_store.make_product_directory(path)
+    with open(path, "wb") as product:
+        product.write(b"\0" * size)
+    _set_age(path, age)
+
+
+def _set_age(path, age):
+    """Set the last access of a file or directory to age seconds ago."""
+    last_access = time.time() - age
+    os.utime(path, (last_access, last_access))
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    """Use an empty product store and disable the shared memory cache."""
+    root = str(tmp_path / "satpy-products")
+    os.makedirs(root)
+    monkeypatch.setattr(product_store, "product_store_root", root)
+    monkeypatch.setattr(product_store, "shm_cache_root", "")
+    return root
+
+
+def test_product_store_path_does_not_create_directory(store):
+    path = product_store.product_store_path(START_TIME, "noaa19", "overview.tif")
+    assert path == os.path.join(store, "2023", "01", "24", "noaa19", "overview.tif")
+    assert not os.path.exists(os.path.dirname(path))
+
+
+def test_cleanup_removes_products_older_than_max_age(store):
+    old = product_store.product_store_path(START_TIME, "noaa19", "old.tif")
+    new = product_store.product_store_path(START_TIME, "noaa19", "new.tif")
+    _write_product(old, 10, 200)
+    _write_product(new, 10, 50)
+
+    removed = product_store.cleanup_products(store, 1000, 100)
+
+    assert removed == 1
+    assert not os.path.exists(old)
+    assert os.path.exists(new)
+
+
+def test_cleanup_removes_least_recently_used_until_below_size(store):
+    paths = [
+        product_store.product_store_path(START_TIME, "noaa19", f"{name}.tif")
+        for name in ("oldest", "older", "newest")
+    ]
+    for age, path in zip((30, 20, 10), paths):
+        _write_product(path, 10, age)
+
+    removed = product_store.cleanup_products(store, 15, 100)
+
+    assert removed == 2
+    assert [os.path.exists(path) for path in paths] == [False, False, True]
+
+
+def test_cleanup_keeps_products_accessed_since_listing(store, monkeypatch):
+    path = product_store.product_store_path(START_TIME, "noaa19", "overview.tif")
+    _write_product(path, 10, 200)
+    list_products = product_store._list_products
+
+    def _list_and_access(root):
+        products = list_products(root)
+        product_store.touch_product(path)
+        return products
+
+    monkeypatch.setattr(product_store, "_list_products", _list_and_access)
+
+    assert product_store.cleanup_products(store, 1000, 100) == 0
+    assert os.path.exists(path)
+
+
+def test_cleanup_never_removes_kept_products(store):
+    path = product_store.product_store_path(START_TIME, "noaa19", "overview.tif")
+    _write_product(path, 10, 200)
+
+    assert product_store.cleanup_products(store, 0, 100, keep=lambda _: True) == 0
+    assert os.path.exists(path)
+
+
+def test_cleanup_removes_old_empty_directories(store):
+    path = product_store.product_store_path(START_TIME, "noaa19", "overview.tif")
+    directory = os.path.dirname(path)
+    os.makedirs(directory)
+    _set_age(directory, product_store.product_store_directory_grace + 10)
+
+    product_store.cleanup_product_store()
+
+    assert not os.path.exists(directory)
+    assert os.path.isdir(store)
+
+
+def test_cleanup_keeps_directory_of_product_about_to_be_written(store):
+    path = product_store.product_store_path(START_TIME, "noaa19", "overview.tif")
+    product_store.make_product_directory(path)
+
+    product_store.cleanup_product_store()
+
+    with open(path, "wb") as product:
+        product.write(b"\0")
+    assert os.path.exists(path)
+
+
+def test_make_product_directory_refreshes_old_empty_directory(store):
+    path = product_store.product_store_path(START_TIME, "noaa19", "overview.tif")
+    directory = os.path.dirname(path)
+    os.makedirs(directory)
+    _set_age(directory, product_store.product_store_directory_grace + 10)
+
+    product_store.make_product_directory(path)
+    product_store.cleanup_product_store()
+
+    assert os.path.isdir(directory)
+
+
+@pytest.fixture
+def shm_cache(store, tmp_path, monkeypatch):
+    """Use an empty shared memory cache next to the product store."""
+    root = str(tmp_path / "shm-cache")
+    os.makedirs(root)
+    monkeypatch.setattr(product_store, "shm_cache_root", root)
+    return root
+
+
+def _write_cached_raster(age, compress_age=None):
+    """Write an old cached raster, and its compress marker if compress_age."""
+    shm_filename = product_store.shm_cache_path(START_TIME, "noaa19", "overview.raw")
+    _write_product(shm_filename, 10, age)
+    if compress_age is not None:
+        marker = product_store.shm_compress_marker(shm_filename)
+        _write_product(marker, 0, compress_age)
+    return shm_filename
+
+
+def test_cleanup_keeps_cached_raster_while_compressed(shm_cache):
+    shm_filename = _write_cached_raster(1000, compress_age=10)
+
+    product_store.cleanup_product_store()
+
+    assert os.path.exists(shm_filename)
+    assert product_store.shm_compress_in_progress(shm_filename)
+
+
+def test_cleanup_removes_orphaned_cached_raster(shm_cache):
+    shm_filename = _write_cached_raster(
+        1000, compress_age=product_store.shm_compress_timeout + 10
+    )
+
+    product_store.cleanup_product_store()
+
+    assert not os.path.exists(shm_filename)
+    assert not os.path.exists(product_store.shm_compress_marker(shm_filename))
+
+
+def test_cleanup_removes_cached_raster_of_written_geotiff(shm_cache):
+    shm_filename = _write_cached_raster(1000, compress_age=10)
+    _write_product(
+        product_store.product_store_path(START_TIME, "noaa19", "overview.tif"), 10, 0
+    )
+
+    product_store.cleanup_product_store()
+
+    assert not os.path.exists(shm_filename)